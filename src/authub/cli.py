@@ -1,17 +1,19 @@
-from pathlib import Path
+import gc
+import os
 
 import typer
 
-from .config import get_settings
-from .orm import compile_schema as _compile_schema
-
 app = typer.Typer()
-settings = get_settings()
 
 
 @app.command()
-def dev(host: str = settings.host, port: int = settings.port):
+def dev(host: str = None, port: int = None):
     """Run the development server."""
+    from .config import get_settings
+
+    settings = get_settings()
+    host = host or settings.host
+    port = port or settings.port
     try:
         import uvicorn
     except ImportError:
@@ -28,14 +30,15 @@ def dev(host: str = settings.host, port: int = settings.port):
 
 
 @app.command()
-def run(
-    host: str = settings.host,
-    port: int = settings.port,
-    workers: int = settings.workers,
-):
+def run(host: str = None, port: int = None, workers: int = None):
     """Run the production server."""
+    from .config import get_settings
+
+    settings = get_settings()
+    host = host or settings.host
+    port = port or settings.port
+    workers = workers or settings.workers
     try:
-        import multiprocessing
         import gunicorn.app.base
         import uvicorn
     except ImportError as e:
@@ -48,15 +51,25 @@ def run(
         raise typer.Exit(1)
 
     class StandaloneApplication(gunicorn.app.base.BaseApplication):
+        def __init__(self):
+            from .http import get_http_app
+
+            # Keep the long-lived app objects out of the GC generations
+            # so that the forked workers don't touch their memory pages.
+            gc.disable()
+            self._app = get_http_app()
+            super().__init__()
+            gc.freeze()
+            gc.enable()
+
         def load_config(self):
             self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
             self.cfg.set("bind", f"{host}:{port}")
             self.cfg.set("workers", workers)
+            self.cfg.set("preload_app", True)
 
         def load(self):
-            from .http import get_http_app
-
-            return get_http_app()
+            return self._app
 
     StandaloneApplication().run()
 
@@ -64,8 +77,9 @@ def run(
 @app.command()
 def compile_schema():
     """Update database schema SDL."""
+    from .orm import compile_schema as _compile_schema
 
-    _compile_schema(Path("dbschema").resolve().absolute())
+    _compile_schema(os.path.abspath("dbschema"))
 
 
 if __name__ == "__main__":
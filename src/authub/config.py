@@ -1,8 +1,8 @@
-import multiprocessing
 import os
 from functools import lru_cache
+from typing import Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseSettings, validator
 
 
 class Settings(BaseSettings):
@@ -11,14 +11,21 @@ class Settings(BaseSettings):
 
     host: str = "localhost"
     port: int = 8000
-    workers: int = multiprocessing.cpu_count() * 2 + 1
+    workers: int = 0
     session_secret: str
 
     edgedb_dsn = "authub"
+    edgedb_pool_min_size: int = 1
+    edgedb_pool_max_size: int = 10
+    edgedb_pool_recycle: Optional[int] = None
 
     token_expires_in: int = 86400
     authorization_code_expires_in: int = 300
 
+    @validator("workers", always=True)
+    def default_workers(cls, v):
+        return v or (os.cpu_count() or 1) * 2 + 1
+
     class Config:
         env_prefix = "authub_"
         env_file = os.environ.get("AUTHUB_ENV_FILE", ".env")
@@ -27,3 +34,9 @@ class Settings(BaseSettings):
 @lru_cache()
 def get_settings() -> Settings:
     return Settings()
+
+
+def __getattr__(name):
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,39 +1,86 @@
-from importlib.metadata import entry_points
+import asyncio
+import logging
+import random
 
 import edgedb
-from fastapi import FastAPI, HTTPException, status, Request, APIRouter
-from fastapi.exception_handlers import http_exception_handler
+from fastapi import FastAPI, status, Response, APIRouter
+from fastapi.responses import ORJSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 
 from .config import get_settings
+from .utils import get_entry_points
 
+logger = logging.getLogger(__name__)
+_NOT_FOUND_BODY = b'{"detail":"Not Found"}'
+_pool = None
+_recycler = None
 
-def get_edgedb_pool(request: Request):
-    return request.app.state.db
+
+async def get_edgedb_pool():
+    return _pool
+
+
+def not_found_response():
+    return Response(
+        _NOT_FOUND_BODY,
+        status_code=status.HTTP_404_NOT_FOUND,
+        media_type="application/json",
+    )
+
+
+async def _recycle_connections(pool, interval):
+    """Expires the pooled connections every `interval` seconds, so that no
+    connection older than that is handed out: expired ones are reconnected
+    on their next acquire.
+
+    The first expiry is delayed randomly within the interval, so that the
+    workers don't all reconnect at the same moment.
+    """
+    await asyncio.sleep(random.uniform(0, interval))
+    while True:
+        try:
+            await pool.expire_connections()
+        except Exception:
+            logger.exception("Failed to expire the EdgeDB connections")
+        await asyncio.sleep(interval)
 
 
 def get_http_app():
     settings = get_settings()
-    app = FastAPI(debug=settings.debug, title=settings.app_name)
+    app = FastAPI(
+        debug=settings.debug,
+        title=settings.app_name,
+        default_response_class=ORJSONResponse,
+    )
     app.add_middleware(SessionMiddleware, secret_key=settings.session_secret)
 
     @app.on_event("startup")
     async def setup_edgedb_pool():
-        app.state.db = await edgedb.create_async_pool(settings.edgedb_dsn)
+        global _pool, _recycler
+        _pool = await edgedb.create_async_pool(
+            settings.edgedb_dsn,
+            min_size=settings.edgedb_pool_min_size,
+            max_size=settings.edgedb_pool_max_size,
+        )
+        if settings.edgedb_pool_recycle:
+            _recycler = asyncio.create_task(
+                _recycle_connections(_pool, settings.edgedb_pool_recycle)
+            )
 
     @app.on_event("shutdown")
     async def setup_edgedb_pool():
-        db = app.state.db
-        del app.state.db
+        global _pool, _recycler
+        if _recycler is not None:
+            _recycler.cancel()
+            _recycler = None
+        db, _pool = _pool, None
         await db.aclose()
 
     @app.exception_handler(edgedb.NoDataError)
     async def no_data_handler(request, exc):
-        return await http_exception_handler(
-            request, HTTPException(status.HTTP_404_NOT_FOUND)
-        )
+        return not_found_response()
 
-    for ep in entry_points()["authub.http"]:
+    for ep in get_entry_points("authub.http"):
         router = ep.load()
         if not isinstance(router, APIRouter):
             router = router(app)
@@ -1,6 +1,7 @@
+import asyncio
+from collections import defaultdict
 from functools import lru_cache
 from importlib import import_module
-from importlib.metadata import entry_points
 from typing import List
 from uuid import UUID
 
@@ -10,22 +11,33 @@ from fastapi import (
     status,
     Request,
     Response,
-    HTTPException,
 )
 from fastapi.responses import RedirectResponse
 from pydantic import BaseModel
 from starlette.routing import get_name
 from authlib.integrations.starlette_client import OAuth
 
-from ..http import get_edgedb_pool
+from ..http import get_edgedb_pool, not_found_response
+from ..orm import get_module_models
+from ..utils import get_entry_points, url_template_for
 
 oauth = OAuth()
+_oauth_clients = {}
+_oauth_client_locks = defaultdict(asyncio.Lock)
+_idp_type_index = {}
+_idp_of_client = {}
+
+_LIST_CLIENTS_QUERY = "SELECT IdPClient { id, name, __type__: { name } }"
+_DELETE_CLIENT_QUERY = "DELETE IdPClient FILTER .id = <uuid>$id"
+_GET_CLIENT_TYPE_QUERY = (
+    "SELECT IdPClient { __type__: { name } } FILTER .id = <uuid>$id"
+)
 
 
 @lru_cache()
 def get_idps():
     rv = {}
-    for ep in entry_points()["authub.idps"]:
+    for ep in get_entry_points("authub.idps"):
         idp: IdPRouter = ep.load()
         if ep.name != idp.name:
             # TODO: warn about mismatching names
@@ -36,6 +48,32 @@ def get_idps():
     return rv
 
 
+@lru_cache()
+def get_idp_type_index():
+    """Returns the mapping from EdgeDB type names to IdP names."""
+    get_idps()
+    return _idp_type_index
+
+
+async def get_oauth_client(db, idp_client_id, register):
+    """Returns the OAuth client of the given IdP client.
+
+    On the first call of each IdP client, `register(db, idp_client_id)` is
+    awaited to load it from the database and register it to `oauth`.
+    """
+    client = _oauth_clients.get(idp_client_id)
+    if client is None:
+        try:
+            async with _oauth_client_locks[idp_client_id]:
+                client = _oauth_clients.get(idp_client_id)
+                if client is None:
+                    client = await register(db, idp_client_id)
+                    _oauth_clients[idp_client_id] = client
+        finally:
+            _oauth_client_locks.pop(idp_client_id, None)
+    return client
+
+
 class IdPRouter(APIRouter):
     def __init__(self, name: str, priority: int = 100):
         super().__init__(prefix=f"/{name}", tags=[name.title()])
@@ -43,11 +81,13 @@ class IdPRouter(APIRouter):
         self.priority = priority
         self.description = None
         self._module = None
+        self._name_prefix = f"{name}."
 
     def add_api_route(self, path, endpoint, name=None, **kwargs):
-        name = get_name(endpoint) if name is None else name
+        if name is None:
+            name = getattr(endpoint, "__name__", None) or get_name(endpoint)
         super().add_api_route(
-            path, endpoint, name=f"{self.name}.{name}", **kwargs
+            path, endpoint, name=self._name_prefix + name, **kwargs
         )
 
     @property
@@ -58,6 +98,8 @@ class IdPRouter(APIRouter):
     def module(self, module):
         self._module = module
         self.description = module.__doc__
+        for model in get_module_models(module):
+            _idp_type_index[f"{self.name}::{model.__name__}"] = self.name
 
 
 router = APIRouter(prefix="/idps", tags=["Identity Providers"])
@@ -93,26 +135,27 @@ class IdPClient(BaseModel):
     summary="List all configured IdP clients.",
 )
 async def get_clients(request: Request, db=Depends(get_edgedb_pool)):
-    result = await db.query(
-        """
-        SELECT IdPClient {
-            id,
-            name,
-            __type__: { name },
-        }
-    """
-    )
-    return [
-        IdPClient(
-            href=request.url_for(f"{mod}.get_client", idp_client_id=obj.id),
-            name=obj.name,
-            idp=mod,
-            login_uri=request.url_for("login", idp_client_id=obj.id),
-        )
-        for mod, obj in (
-            (obj.__type__.name.split("::")[0], obj) for obj in result
+    result = await db.query(_LIST_CLIENTS_QUERY)
+    index = get_idp_type_index()
+    login_url = url_template_for(request, "login", "idp_client_id")
+    client_urls = {}
+    rv = []
+    for obj in result:
+        mod = index[obj.__type__.name]
+        client_url = client_urls.get(mod)
+        if client_url is None:
+            client_url = client_urls[mod] = url_template_for(
+                request, f"{mod}.get_client", "idp_client_id"
+            )
+        rv.append(
+            IdPClient(
+                href=client_url(obj.id),
+                name=obj.name,
+                idp=mod,
+                login_uri=login_url(obj.id),
+            )
         )
-    ]
+    return rv
 
 
 @router.delete(
@@ -122,37 +165,37 @@ async def get_clients(request: Request, db=Depends(get_edgedb_pool)):
     summary="Remove the specified IdP client.",
 )
 async def remove_client(idp_client_id: UUID, db=Depends(get_edgedb_pool)):
-    result = await db.query_one(
-        """
-        DELETE IdPClient
-        FILTER .id = <uuid>$id
-    """,
-        id=idp_client_id,
-    )
+    result = await db.query_one(_DELETE_CLIENT_QUERY, id=idp_client_id)
+    _idp_of_client.pop(idp_client_id, None)
+    _oauth_clients.pop(idp_client_id, None)
     if result:
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        return not_found_response()
+
+
+async def _get_idp_of_client(db, idp_client_id):
+    # The IdP of a client never changes, so it is only queried once
+    try:
+        return _idp_of_client[idp_client_id]
+    except KeyError:
+        result = await db.query_one(_GET_CLIENT_TYPE_QUERY, id=idp_client_id)
+        mod = get_idp_type_index()[result.__type__.name]
+        _idp_of_client[idp_client_id] = mod
+        return mod
 
 
 @router.get(
     "/clients/{idp_client_id}/login",
     summary="Login through the specified IdP client.",
+    response_class=RedirectResponse,
     status_code=status.HTTP_302_FOUND,
     responses={status.HTTP_404_NOT_FOUND: {}},
 )
 async def login(
     idp_client_id: UUID, request: Request, db=Depends(get_edgedb_pool)
 ):
-    result = await db.query_one(
-        """
-        SELECT IdPClient {
-            __type__: { name },
-        } FILTER .id = <uuid>$id
-    """,
-        id=idp_client_id,
-    )
-    mod = result.__type__.name.split("::")[0]
+    mod = await _get_idp_of_client(db, idp_client_id)
     return RedirectResponse(
         request.url_for(f"{mod}.login", idp_client_id=idp_client_id),
         status_code=status.HTTP_302_FOUND,
@@ -1,14 +1,18 @@
 """GitHub OAuth 2.0 identity provider."""
 
+from functools import lru_cache
 from uuid import UUID
 
+import orjson
 from fastapi import Depends, status, Request
+from fastapi.responses import RedirectResponse
 from pydantic import BaseModel
 
-from .base import IdPRouter, oauth
+from .base import IdPRouter, get_oauth_client, oauth
 from ..http import get_edgedb_pool
 from ..models import IdPClient, Identity as BaseIdentity, Href, User
 from ..orm import with_block, prop
+from ..utils import url_template_for
 
 
 class Client(IdPClient):
@@ -56,6 +60,8 @@ class Identity(BaseIdentity):
 
 
 idp = IdPRouter("github")
+_AUTHORIZE_ROUTE = f"{idp.name}.authorize"
+_GET_CLIENT_ROUTE = f"{idp.name}.get_client"
 
 
 class GitHubClientOut(BaseModel):
@@ -79,7 +85,7 @@ async def get_client(
     )
     return GitHubClientOut(
         redirect_uri=request.url_for(
-            f"{idp.name}.authorize", idp_client_id=idp_client_id
+            _AUTHORIZE_ROUTE, idp_client_id=idp_client_id
         ),
         **Client.from_obj(result).dict(),
     )
@@ -104,38 +110,36 @@ async def add_client(
         Client(**client.dict()).insert(),
         **client.dict(),
     )
-    return Href(
-        href=request.url_for(f"{idp.name}.get_client", idp_client_id=result.id)
+    client_url = url_template_for(request, _GET_CLIENT_ROUTE, "idp_client_id")
+    return Href(href=client_url(result.id))
+
+
+async def _register_github_client(db, idp_client_id):
+    result = await db.query_one(
+        Client.select("client_id", "client_secret", filters=".id = <uuid>$id"),
+        id=idp_client_id,
+    )
+    client = Client.from_obj(result)
+    return oauth.register(
+        name=idp_client_id.hex,
+        client_id=client.client_id,
+        client_secret=client.client_secret,
+        access_token_url="https://github.com/login/oauth/access_token",
+        authorize_url="https://github.com/login/oauth/authorize",
+        api_base_url="https://api.github.com/",
+        client_kwargs={"scope": "user:email"},
     )
 
 
 async def _get_github_client(db, idp_client_id):
-    try:
-        client = getattr(oauth, idp_client_id.hex)
-    except AttributeError:
-        result = await db.query_one(
-            Client.select(
-                "client_id", "client_secret", filters=".id = <uuid>$id"
-            ),
-            id=idp_client_id,
-        )
-        client = Client.from_obj(result)
-        client = oauth.register(
-            name=idp_client_id.hex,
-            client_id=client.client_id,
-            client_secret=client.client_secret,
-            access_token_url="https://github.com/login/oauth/access_token",
-            authorize_url="https://github.com/login/oauth/authorize",
-            api_base_url="https://api.github.com/",
-            client_kwargs={"scope": "user:email"},
-        )
-    return client
+    return await get_oauth_client(db, idp_client_id, _register_github_client)
 
 
 @idp.get(
     "/clients/{idp_client_id}/login",
     summary="Login through the specified GitHub OAuth 2.0 client.",
-    status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+    response_class=RedirectResponse,
+    status_code=status.HTTP_302_FOUND,
 )
 async def login(
     idp_client_id: UUID, request: Request, db=Depends(get_edgedb_pool)
@@ -143,7 +147,7 @@ async def login(
     github_client = await _get_github_client(db, idp_client_id)
     return await github_client.authorize_redirect(
         request,
-        request.url_for(f"{idp.name}.authorize", idp_client_id=idp_client_id),
+        request.url_for(_AUTHORIZE_ROUTE, idp_client_id=idp_client_id),
     )
 
 
@@ -158,10 +162,11 @@ async def authorize(
     token = await github_client.authorize_access_token(request)
     resp = await github_client.get("user", token=token)
     resp.raise_for_status()
-    profile = resp.json()
+    profile = orjson.loads(resp.content)
     profile["github_id"] = profile.pop("id")
     profile["hireable"] = bool(profile["hireable"])
     identity = Identity.construct(**token, **profile)
+    identity_data = identity.dict(exclude_unset=True)
     client = Client.select(filters=".id = <uuid>$client_id")
     result = await db.query_one(
         "SELECT ("
@@ -175,20 +180,21 @@ async def authorize(
         )
         + ") { id, user: { id }, client: { id } }",
         client_id=idp_client_id,
-        **identity.dict(exclude_unset=True),
+        **identity_data,
     )
     if "client_id" in request.session:
         from authub.oauth2 import oauth2_authorized
 
-        return await oauth2_authorized(request, User.from_obj(result.user))
-    else:
-        identity = Identity(
-            id=result.id,
-            user=User.from_obj(result.user),
-            client=Client.from_obj(result.client),
-            **identity.dict(exclude_unset=True),
+        return await oauth2_authorized(
+            request, User.construct(id=result.user.id)
         )
-        return identity.dict()
+    else:
+        return {
+            "id": result.id,
+            "user": {"id": result.user.id},
+            "client": {"id": result.client.id},
+            **identity_data,
+        }
 
 
 class IdentityOut(BaseModel):
@@ -223,6 +229,14 @@ class IdentityOut(BaseModel):
     updated_at: str  # '2021-03-03T00:31:04Z'
 
 
+@lru_cache()
+def _get_identity_query():
+    return Identity.select(
+        *IdentityOut.schema()["properties"],
+        filters=".id = <uuid>$id",
+    )
+
+
 @idp.get(
     "/identities/{identity_id}",
     response_model=IdentityOut,
@@ -231,30 +245,15 @@ class IdentityOut(BaseModel):
     summary="Get the profile of the specified GitHub identity.",
 )
 async def get_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
-    result = await db.query_one(
-        Identity.select(
-            *IdentityOut.schema()["properties"],
-            filters=".id = <uuid>$id",
-        ),
-        id=identity_id,
-    )
+    result = await db.query_one(_get_identity_query(), id=identity_id)
     return IdentityOut(**Identity.from_obj(result).dict())
 
 
-@idp.patch(
-    "/identities/{identity_id}/utilize",
-    response_model=User,
-    summary="Update the user's profile with the specified GitHub identity.",
-)
-async def utilize_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
-    result = await db.query_one(
+@lru_cache()
+def _utilize_identity_query():
+    return (
         with_block(
-            identity=Identity.select(
-                "user: { id }",
-                "email",
-                "name",
-                filters=".id = <uuid>$identity_id",
-            )
+            identity=Identity.select(filters=".id = <uuid>$identity_id")
         )
         + "SELECT ("
         + User.construct().update(
@@ -262,7 +261,17 @@ async def utilize_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
             email="identity.email",
             name="identity.name",
         )
-        + ") { id, email, name }",
-        identity_id=identity_id,
+        + ") { id, email, name }"
+    )
+
+
+@idp.patch(
+    "/identities/{identity_id}/utilize",
+    response_model=User,
+    summary="Update the user's profile with the specified GitHub identity.",
+)
+async def utilize_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
+    result = await db.query_one(
+        _utilize_identity_query(), identity_id=identity_id
     )
     return User.from_obj(result)
@@ -1,14 +1,18 @@
 """Google OpenID Connect identity provider."""
 
+import asyncio
+from functools import lru_cache
 from uuid import UUID
 
 from fastapi import Depends, status, Request
+from fastapi.responses import RedirectResponse
 from pydantic import BaseModel
 
-from .base import IdPRouter, oauth
+from .base import IdPRouter, get_oauth_client, oauth
 from ..http import get_edgedb_pool
 from ..models import IdPClient, Identity as BaseIdentity, Href, User
 from ..orm import ExtendedComputableProperty, ExclusiveConstraint, with_block
+from ..utils import url_template_for
 
 
 class Client(IdPClient):
@@ -46,6 +50,8 @@ class Identity(BaseIdentity):
 
 
 idp = IdPRouter("google")
+_AUTHORIZE_ROUTE = f"{idp.name}.authorize"
+_GET_CLIENT_ROUTE = f"{idp.name}.get_client"
 
 
 class GoogleClientOut(BaseModel):
@@ -74,7 +80,7 @@ async def get_client(
     )
     return GoogleClientOut(
         redirect_uri=request.url_for(
-            f"{idp.name}.authorize", idp_client_id=idp_client_id
+            _AUTHORIZE_ROUTE, idp_client_id=idp_client_id
         ),
         **Client.from_obj(result).dict(),
     )
@@ -105,39 +111,81 @@ async def add_client(
     """,
         **client.dict(),
     )
-    return Href(
-        href=request.url_for(f"{idp.name}.get_client", idp_client_id=result.id)
+    client_url = url_template_for(request, _GET_CLIENT_ROUTE, "idp_client_id")
+    return Href(href=client_url(result.id))
+
+
+_SERVER_METADATA_URL = (
+    "https://accounts.google.com/.well-known/openid-configuration"
+)
+_server_metadata = {}
+_prefetcher = None
+
+
+async def _register_google_client(db, idp_client_id):
+    result = await db.query_one(
+        """
+        SELECT google::Client {
+            client_id,
+            client_secret,
+        } FILTER .id = <uuid>$id
+    """,
+        id=idp_client_id,
     )
+    client = Client.from_obj(result)
+    rv = oauth.register(
+        name=idp_client_id.hex,
+        server_metadata_url=_SERVER_METADATA_URL,
+        client_id=client.client_id,
+        client_secret=client.client_secret,
+        client_kwargs={"scope": "openid email profile"},
+    )
+    rv.server_metadata.update(_server_metadata)
+    return rv
 
 
 async def _get_google_client(db, idp_client_id):
+    return await get_oauth_client(db, idp_client_id, _register_google_client)
+
+
+async def _prefetch_server_metadata():
     try:
-        client = getattr(oauth, idp_client_id.hex)
-    except AttributeError:
-        result = await db.query_one(
-            """
-            SELECT google::Client {
-                client_id,
-                client_secret,
-            } FILTER .id = <uuid>$id
-        """,
-            id=idp_client_id,
+        db = await get_edgedb_pool()
+        result = await db.query("SELECT google::Client { id }")
+        google_clients = await asyncio.gather(
+            *(_get_google_client(db, client.id) for client in result)
         )
-        client = Client.from_obj(result)
-        client = oauth.register(
-            name=idp_client_id.hex,
-            server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
-            client_id=client.client_id,
-            client_secret=client.client_secret,
-            client_kwargs={"scope": "openid email profile"},
-        )
-    return client
+        if google_clients and not _server_metadata:
+            metadata = await google_clients[0].load_server_metadata()
+            _server_metadata.update(metadata)
+            for google_client in google_clients[1:]:
+                google_client.server_metadata.update(metadata)
+    except Exception:
+        # Best effort only, the first login loads whatever is missing.
+        pass
+
+
+@idp.on_event("startup")
+async def prefetch_server_metadata():
+    """Registers the configured clients and fetches Google's discovery
+    document once for all of them, in the background."""
+    global _prefetcher
+    _prefetcher = asyncio.create_task(_prefetch_server_metadata())
+
+
+@idp.on_event("shutdown")
+async def cancel_prefetch():
+    global _prefetcher
+    if _prefetcher is not None:
+        _prefetcher.cancel()
+        _prefetcher = None
 
 
 @idp.get(
     "/clients/{idp_client_id}/login",
     summary="Login through the specified Google OIDC client.",
-    status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+    response_class=RedirectResponse,
+    status_code=status.HTTP_302_FOUND,
 )
 async def login(
     idp_client_id: UUID, request: Request, db=Depends(get_edgedb_pool)
@@ -145,7 +193,7 @@ async def login(
     google_client = await _get_google_client(db, idp_client_id)
     return await google_client.authorize_redirect(
         request,
-        request.url_for(f"{idp.name}.authorize", idp_client_id=idp_client_id),
+        request.url_for(_AUTHORIZE_ROUTE, idp_client_id=idp_client_id),
     )
 
 
@@ -160,6 +208,7 @@ async def authorize(
     token = await google_client.authorize_access_token(request)
     user = await google_client.parse_id_token(request, token)
     identity = Identity.construct(**token, **user)
+    identity_data = identity.dict(exclude={"nonce"}, exclude_unset=True)
     client = Client.select(filters=".id = <uuid>$client_id")
     result = await db.query_one(
         "SELECT ("
@@ -173,20 +222,21 @@ async def authorize(
         )
         + ") { id, user: { id }, client: { id } }",
         client_id=idp_client_id,
-        **identity.dict(exclude={"nonce"}, exclude_unset=True),
+        **identity_data,
     )
     if "client_id" in request.session:
         from authub.oauth2 import oauth2_authorized
 
-        return await oauth2_authorized(request, User.from_obj(result.user))
-    else:
-        identity = Identity(
-            id=result.id,
-            user=User.from_obj(result.user),
-            client=Client.from_obj(result.client),
-            **identity.dict(exclude_unset=True),
+        return await oauth2_authorized(
+            request, User.construct(id=result.user.id)
         )
-        return identity.dict()
+    else:
+        return {
+            "id": result.id,
+            "user": {"id": result.user.id},
+            "client": {"id": result.client.id},
+            **identity_data,
+        }
 
 
 class IdentityOut(BaseModel):
@@ -201,6 +251,14 @@ class IdentityOut(BaseModel):
     locale: str  # "en"
 
 
+@lru_cache()
+def _get_identity_query():
+    return Identity.select(
+        *IdentityOut.schema()["properties"],
+        filters=".id = <uuid>$id",
+    )
+
+
 @idp.get(
     "/identities/{identity_id}",
     response_model=IdentityOut,
@@ -209,30 +267,15 @@ class IdentityOut(BaseModel):
     summary="Get the profile of the specified Google identity.",
 )
 async def get_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
-    result = await db.query_one(
-        Identity.select(
-            *IdentityOut.schema()["properties"],
-            filters=".id = <uuid>$id",
-        ),
-        id=identity_id,
-    )
+    result = await db.query_one(_get_identity_query(), id=identity_id)
     return IdentityOut(**Identity.from_obj(result).dict())
 
 
-@idp.patch(
-    "/identities/{identity_id}/utilize",
-    response_model=User,
-    summary="Update the user's profile with the specified Google identity.",
-)
-async def utilize_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
-    result = await db.query_one(
+@lru_cache()
+def _utilize_identity_query():
+    return (
         with_block(
-            identity=Identity.select(
-                "user: { id }",
-                "email",
-                "name",
-                filters=".id = <uuid>$identity_id",
-            )
+            identity=Identity.select(filters=".id = <uuid>$identity_id")
         )
         + "SELECT ("
         + User.construct().update(
@@ -240,7 +283,17 @@ async def utilize_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
             email="identity.email",
             name="identity.name",
         )
-        + ") { id, email, name }",
-        identity_id=identity_id,
+        + ") { id, email, name }"
+    )
+
+
+@idp.patch(
+    "/identities/{identity_id}/utilize",
+    response_model=User,
+    summary="Update the user's profile with the specified Google identity.",
+)
+async def utilize_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
+    result = await db.query_one(
+        _utilize_identity_query(), identity_id=identity_id
     )
     return User.from_obj(result)
@@ -1,8 +1,10 @@
-import json
+import asyncio
+import time
 from functools import lru_cache
 from typing import Optional, Union, Type, List
 from uuid import uuid4, UUID
 
+import orjson
 from aioauth.base.database import BaseDB
 from aioauth.config import Settings
 from aioauth.models import (
@@ -32,7 +34,6 @@ from fastapi import (
     Response,
     Depends,
     status,
-    HTTPException,
 )
 from fastapi.responses import RedirectResponse
 from fastapi.security import OAuth2AuthorizationCodeBearer
@@ -40,12 +41,49 @@ from pydantic import BaseModel
 from starlette.authentication import AuthenticationBackend
 
 from .config import get_settings
-from .http import get_edgedb_pool
+from .http import get_edgedb_pool, not_found_response
 from .models import DatabaseModel, User, IdPClient
 from .orm import with_block, ComputableProperty
+from .utils import url_template_for
 
 router = APIRouter(prefix="/oauth2", tags=["OAuth 2.0"])
 
+# Tokens are cached per process: a revocation only evicts the token from the
+# worker that handled it, so the TTL bounds how long others may still see it.
+# The cache wraps DB.get_token(), the one place tokens are read from the
+# database, as OAuth2Backend.authenticate() doesn't resolve bearer tokens
+# yet. It stays inert until get_token() gets its database lookup.
+_TOKEN_CACHE_TTL = 300
+_TOKEN_CACHE_MAX_SIZE = 10000
+_token_cache = {}
+_refresh_tokens = {}
+
+
+def _get_cached_token(access_token):
+    entry = _token_cache.get(access_token)
+    if entry is not None:
+        expires_at, token = entry
+        if expires_at > time.time():
+            return token
+        _uncache_token(token.refresh_token)
+
+
+def _cache_token(token: OAuth2Token):
+    now = time.time()
+    expires_at = min(now + _TOKEN_CACHE_TTL, token.token_expires_in)
+    if token.revoked or expires_at <= now:
+        return
+    if len(_token_cache) >= _TOKEN_CACHE_MAX_SIZE:
+        _uncache_token(next(iter(_token_cache.values()))[1].refresh_token)
+    _token_cache[token.access_token] = (expires_at, token)
+    _refresh_tokens[token.refresh_token] = token.access_token
+
+
+def _uncache_token(refresh_token):
+    access_token = _refresh_tokens.pop(refresh_token, None)
+    if access_token is not None:
+        _token_cache.pop(access_token, None)
+
 
 class Client(DatabaseModel):
     client_secret: str
@@ -86,6 +124,11 @@ class OAuth2Backend(AuthenticationBackend):
         print("token", token)
 
 
+@lru_cache()
+def _get_client_query():
+    return Client.select(*OAuth2Client._fields, filters=".id = <uuid>$id")
+
+
 class DB(BaseDB):
     """Class for interacting with the database. Used by `AuthorizationServer`.
 
@@ -129,17 +172,31 @@ class DB(BaseDB):
         )
         return authorization_code
 
-    async def get_token(self, *args, **kwargs) -> Optional[OAuth2Token]:
+    async def get_token(
+        self,
+        request: OAuth2Request,
+        client_id: str,
+        access_token: Optional[str] = None,
+        refresh_token: Optional[str] = None,
+    ) -> Optional[OAuth2Token]:
         """Get token from the database by provided request from user.
 
+        Tokens looked up by access token are served from the in-process
+        cache while it's valid.
+
         Returns:
             Token: if token exists in db.
             None: if no token in db.
         """
+        if access_token is not None:
+            token = _get_cached_token(access_token)
+            if token is not None and token.client_id == client_id:
+                return token
+
         token_record = ...
 
         if token_record is not None:
-            return OAuth2Token(
+            token = OAuth2Token(
                 access_token=token_record.access_token,
                 refresh_token=token_record.refresh_token,
                 scope=token_record.scope,
@@ -149,6 +206,8 @@ class DB(BaseDB):
                 token_type=token_record.token_type,
                 revoked=token_record.revoked,
             )
+            _cache_token(token)
+            return token
 
     async def get_client(
         self,
@@ -164,7 +223,7 @@ class DB(BaseDB):
         """
 
         client_record = await self._db.query_one(
-            Client.select(*OAuth2Client._fields, filters=".id = <uuid>$id"),
+            _get_client_query(),
             id=client_id,
         )
         client_record = Client.from_obj(client_record)
@@ -179,11 +238,14 @@ class DB(BaseDB):
                 scope=client_record.scope,
             )
 
-    async def revoke_token(self, request: Request, token: str) -> None:
+    async def revoke_token(
+        self, request: OAuth2Request, refresh_token: str
+    ) -> None:
         """Revokes an existing token. The `revoked`
 
         Flag of the Token must be set to True
         """
+        _uncache_token(refresh_token)
         token_record = ...
         token_record.revoked = True
         token_record.save()
@@ -231,15 +293,21 @@ def get_aioauth_settings():
     )
 
 
-def _url_for(base_url, name, **path_params):
-    return router.url_path_for(name, **path_params).make_absolute_url(base_url)
+@lru_cache()
+def _get_oauth2_paths():
+    return (
+        router.url_path_for("oauth2_authorize"),
+        router.url_path_for("oauth2_token"),
+    )
 
 
-@lru_cache()
+@lru_cache(maxsize=32)
 def _get_oauth2_scheme(base_url):
+    authorize_path, token_path = _get_oauth2_paths()
+    base_url = base_url.rstrip("/")
     return OAuth2AuthorizationCodeBearer(
-        authorizationUrl=_url_for(base_url, "oauth2_authorize"),
-        tokenUrl=_url_for(base_url, "oauth2_token"),
+        authorizationUrl=base_url + authorize_path,
+        tokenUrl=base_url + token_path,
         auto_error=False,
     )
 
@@ -250,12 +318,15 @@ def oauth2_schema(request: Request):
 
 async def _oauth2_request(request: Request):
     """Converts fastapi Request instance to OAuth2Request instance"""
-    form = await request.form()
+    if request.method == "POST":
+        form = await request.form()
+    else:
+        form = {}
 
     def get(user, query_params):
         post = dict(form)
         method = request.method
-        headers = CaseInsensitiveDict(**request.headers)
+        headers = CaseInsensitiveDict(request.headers)
         url = str(request.url)
 
         return OAuth2Request(
@@ -280,7 +351,7 @@ def _to_fastapi_response(oauth2_response: OAuth2Response):
     )
     headers = dict(oauth2_response.headers)
     status_code = oauth2_response.status_code
-    content = json.dumps(response_content)
+    content = orjson.dumps(response_content)
 
     return Response(content=content, headers=headers, status_code=status_code)
 
@@ -302,14 +373,19 @@ async def oauth2_authorize(
 
     See Section 4.1.1: https://tools.ietf.org/html/rfc6749#section-4.1.1
     """
+    query_params = dict(request.query_params)
+    query_params.pop("idp_client_id", None)
     if idp_client_id:
-        await db.query_one(
+        query = db.query_one(
             IdPClient.select(filters=".id = <uuid>$id"),
             id=idp_client_id,
         )
-    query_params = dict(request.query_params)
-    query_params.pop("idp_client_id", None)
-    await server.validate_authorize_request(oauth2_request(True, query_params))
+    else:
+        query = db.query(IdPClient.select("id", "name"))
+    result, _ = await asyncio.gather(
+        query,
+        server.validate_authorize_request(oauth2_request(True, query_params)),
+    )
     request.session["client_id"] = str(client_id)
     request.session["redirect_uri"] = redirect_uri
     request.session["response_type"] = response_type
@@ -320,23 +396,20 @@ async def oauth2_authorize(
             request.url_for("login", idp_client_id=idp_client_id)
         )
 
-    clients = await db.query(IdPClient.select("id", "name"))
-    return {
-        client.name: request.url_for("login", idp_client_id=client.id)
-        for client in clients
-    }
+    login_url = url_template_for(request, "login", "idp_client_id")
+    return {client.name: login_url(client.id) for client in result}
 
 
 async def oauth2_authorized(request: Request, user):
-    async for tx in request.app.state.db.retrying_transaction():
+    query_params = {}
+    for key in ["client_id", "redirect_uri", "response_type", "scope"]:
+        query_params[key] = request.session.pop(key)
+    oauth2_request = (await _oauth2_request(request))(user, query_params)
+    db = await get_edgedb_pool()
+    async for tx in db.retrying_transaction():
         async with tx:
             server = AuthubServer(tx)
-            query_params = {}
-            for key in ["client_id", "redirect_uri", "response_type", "scope"]:
-                query_params[key] = request.session.pop(key)
-            resp = await server.create_authorization_response(
-                (await _oauth2_request(request))(user, query_params)
-            )
+            resp = await server.create_authorization_response(oauth2_request)
     return _to_fastapi_response(resp)
 
 
@@ -356,14 +429,17 @@ class OAuth2ClientListOut(BaseModel):
     href: str
 
 
+@lru_cache()
+def _list_oauth2_clients_query():
+    return Client.select("id", "client_id")
+
+
 @router.get("/clients", response_model=List[OAuth2ClientListOut])
 async def list_oauth2_clients(request: Request, db=Depends(get_edgedb_pool)):
-    result = await db.query(Client.select("id", "client_id"))
+    result = await db.query(_list_oauth2_clients_query())
+    client_url = url_template_for(request, "get_oauth2_client", "client_id")
     return [
-        OAuth2ClientListOut(
-            client_id=obj.client_id,
-            href=request.url_for("get_oauth2_client", client_id=obj.id),
-        )
+        OAuth2ClientListOut(client_id=obj.client_id, href=client_url(obj.id))
         for obj in result
     ]
 
@@ -384,13 +460,14 @@ class NewOAuth2Client(BaseModel):
 async def create_oauth2_clients(
     client: OAuth2ClientIn, db=Depends(get_edgedb_pool)
 ):
-    client_obj = Client(client_secret=uuid4().hex, **client.dict())
+    data = client.dict()
+    data["client_secret"] = uuid4().hex
     result = await db.query_one(
         with_block("oauth2")
         + "SELECT ( "
-        + client_obj.insert(current_module="oauth2")
+        + Client.construct(**data).insert(current_module="oauth2")
         + ") { client_id, client_secret }",
-        **client_obj.dict(exclude={"id"}),
+        **data,
     )
     return NewOAuth2Client(**Client.from_obj(result).dict())
 
@@ -403,14 +480,19 @@ class OAuth2ClientOut(BaseModel):
     scope: str = ""
 
 
+_OAUTH2_CLIENT_OUT_SHAPE = ", ".join(OAuth2ClientOut.__fields__)
+
+
+@lru_cache()
+def _get_oauth2_client_query():
+    return Client.select(
+        *OAuth2ClientOut.__fields__, filters=".id = <uuid>$id"
+    )
+
+
 @router.get("/clients/{client_id}", response_model=OAuth2ClientOut)
 async def get_oauth2_client(client_id: UUID, db=Depends(get_edgedb_pool)):
-    result = await db.query_one(
-        Client.select(
-            *OAuth2ClientOut.schema()["properties"], filters=".id = <uuid>$id"
-        ),
-        id=client_id,
-    )
+    result = await db.query_one(_get_oauth2_client_query(), id=client_id)
     return OAuth2ClientOut(**Client.from_obj(result).dict())
 
 
@@ -418,15 +500,16 @@ async def get_oauth2_client(client_id: UUID, db=Depends(get_edgedb_pool)):
 async def update_oauth2_client(
     client_id: UUID, client: OAuth2ClientIn, db=Depends(get_edgedb_pool)
 ):
+    data = client.dict()
     result = await db.query_one(
         with_block("oauth2")
         + "SELECT ("
-        + Client.construct(**client.dict()).update(filters=".id = <uuid>$id")
+        + Client.construct(**data).update(filters=".id = <uuid>$id")
         + ") { "
-        + ", ".join(OAuth2ClientOut.schema()["properties"])
+        + _OAUTH2_CLIENT_OUT_SHAPE
         + "}",
         id=client_id,
-        **client.dict(),
+        **data,
     )
     return OAuth2ClientOut(**Client.from_obj(result).dict())
 
@@ -440,4 +523,4 @@ async def delete_oauth2_client(client_id: UUID, db=Depends(get_edgedb_pool)):
     if result:
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        return not_found_response()
@@ -1,13 +1,13 @@
-import contextlib
-import inspect
-import io
+import os
 from enum import Enum
 from functools import lru_cache
-from importlib.metadata import entry_points
-from typing import Type, TextIO, Optional, TypeVar, List, get_args, get_origin
+from typing import Type, Optional, TypeVar, List, get_args, get_origin
 from uuid import UUID
 
 from pydantic import BaseModel
+from pydantic.main import ModelMetaclass
+
+from .utils import get_entry_points
 
 _EDB_TYPES = {
     "string": "str",
@@ -17,34 +17,71 @@ _EDB_TYPES = {
 }
 
 
-class DatabaseModel(BaseModel):
+_declarations_stack = []
+_models_by_module = {}
+
+
+def _is_enum(type_):
+    return isinstance(type_, type) and issubclass(type_, Enum)
+
+
+class _DatabaseModelMeta(ModelMetaclass):
+    """Collects the `Declaration`s created in the body of each model class
+    into its `__declarations__`."""
+
+    @classmethod
+    def __prepare__(mcs, name, bases, **kwargs):
+        namespace = super().__prepare__(name, bases, **kwargs)
+        namespace["__declarations__"] = []
+        _declarations_stack.append(namespace["__declarations__"])
+        return namespace
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        # Classes built by calling the metaclass directly, like pydantic's
+        # create_model() does, skip __prepare__ and have nothing to pop.
+        declarations = namespace.get("__declarations__")
+        if _declarations_stack and _declarations_stack[-1] is declarations:
+            _declarations_stack.pop()
+        elif declarations is None:
+            namespace = {**namespace, "__declarations__": []}
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class DatabaseModel(BaseModel, metaclass=_DatabaseModelMeta):
     id: UUID = None
-    __declarations__ = []
     __edb_module__ = None
+    __edb_schemas__ = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__edb_schemas__ = {}
+        if not cls.__name__.startswith("_"):
+            _models_by_module.setdefault(cls.__module__, []).append(cls)
 
     @classmethod
-    @lru_cache()
     def edb_schema(cls, current_module="default", self_only=True):
+        key = current_module, self_only
+        rv = cls.__edb_schemas__.get(key)
+        if rv is None:
+            rv = cls.__edb_schemas__[key] = cls._compile_edb_schema(
+                current_module, self_only
+            )
+        return rv
+
+    @classmethod
+    def _compile_edb_schema(cls, current_module, self_only):
         schema = cls.schema()
 
         def _get_type(attr):
-            if "type" in attr:
-                return _EDB_TYPES[attr["type"]]
-            else:
-                rv = attr["$ref"].split("/")[-1]
-                mod_name = schema["definitions"][rv].get(
-                    "module", current_module
-                )
-                if mod_name != current_module:
-                    rv = f"{mod_name}::{rv}"
-                return rv
-
-        def _is_link(attr):
-            if "type" in attr:
-                return False
-            else:
-                type_ = attr["$ref"].split("/")[-1]
-                return schema["definitions"][type_]["type"] == "object"
+            type_ = attr.get("type")
+            if type_ is not None:
+                return _EDB_TYPES[type_], None
+            rv = attr["$ref"].rsplit("/", 1)[-1]
+            definition = schema["definitions"][rv]
+            mod_name = definition.get("module", current_module)
+            if mod_name != current_module:
+                rv = f"{mod_name}::{rv}"
+            return rv, definition
 
         title = schema["title"]
         module = cls.__edb_module__ or "default"
@@ -53,8 +90,9 @@ class DatabaseModel(BaseModel):
 
         inherited_props = set()
         parents = []
+        is_model = DatabaseModel.issubclass
         for p in cls.__mro__[1:]:
-            if not DatabaseModel.issubclass(p):
+            if not is_model(p):
                 continue
             p_schema = p.edb_schema(current_module)
             inherited_props.update(p_schema["properties"])
@@ -69,13 +107,14 @@ class DatabaseModel(BaseModel):
                 continue
             if name in required:
                 edb_prop["required"] = True
-            if _is_link(attr):
+            type_, definition = _get_type(attr)
+            if definition is not None and definition["type"] == "object":
                 edb_prop["declaration"] = "link"
             else:
                 edb_prop["declaration"] = "property"
-            edb_prop["type"] = _get_type(attr)
+            edb_prop["type"] = type_
             if "items" in attr:
-                edb_prop["items"] = {"type": _get_type(attr["items"])}
+                edb_prop["items"] = {"type": _get_type(attr["items"])[0]}
             if "constraint" in attr:
                 edb_prop["constraint"] = attr["constraint"]
             props[name] = edb_prop
@@ -96,69 +135,94 @@ class DatabaseModel(BaseModel):
 
     @classmethod
     def issubclass(cls, v):
-        return cls in getattr(v, "__mro__", [v])[1:]
+        return v is not cls and isinstance(v, type) and issubclass(v, cls)
 
     @classmethod
-    def from_obj(cls, obj):
-        values = {}
-        for key in dir(obj):
-            value = getattr(obj, key)
-            key_type = cls.__annotations__.get(key)
+    @lru_cache()
+    def _from_obj_converters(cls):
+        rv = {}
+        for key, field in cls.__fields__.items():
+            key_type = field.outer_type_
             if hasattr(key_type, "from_obj"):
-                value = key_type.from_obj(value)
+                rv[key] = key_type.from_obj
             elif get_origin(key_type) is list:
                 sub_type = get_args(key_type)[0]
-                if issubclass(type(sub_type), type) and issubclass(
-                    sub_type, Enum
-                ):
-                    value = [sub_type(str(val)) for val in value]
+                if _is_enum(sub_type):
+                    rv[key] = lambda value, enum=sub_type: list(
+                        map(enum, map(str, value))
+                    )
                 else:
-                    value = [val for val in value]
-            elif issubclass(type(key_type), type) and issubclass(
-                key_type, Enum
-            ):
-                value = key_type(str(value))
+                    rv[key] = list
+            elif _is_enum(key_type):
+                rv[key] = lambda value, enum=key_type: enum(str(value))
+        return rv
+
+    @classmethod
+    def from_obj(cls, obj):
+        converters = cls._from_obj_converters()
+        values = {}
+        for key in dir(obj):
+            value = getattr(obj, key)
+            converter = converters.get(key)
+            if converter is not None and value is not None:
+                value = converter(value)
             values[key] = value
         return cls.construct(**values)
 
     @classmethod
     def select(cls, *expressions, current_module="default", filters=None):
-        buf = io.StringIO()
+        return cls._compile_select(expressions, current_module, filters)
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _compile_select(cls, expressions, current_module, filters):
         schema = cls.edb_schema(current_module)
-        buf.write(f"SELECT {schema['title']}")
+        parts = [f"SELECT {schema['title']}"]
         if expressions:
-            with _curley_braces(buf) as inf:
-                for exp in expressions:
-                    print(f"{exp},", file=inf)
+            parts.append(_compile_block(f"{exp}," for exp in expressions))
         elif filters:
-            buf.write(" ")
+            parts.append(" ")
         if filters:
-            buf.write("FILTER ")
-            buf.write(filters)
-        return buf.getvalue()
+            parts.append(f"FILTER {filters}")
+        return "".join(parts)
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _compile_value_lines(cls, current_module, include, exclude):
+        schema = cls.edb_schema(current_module, self_only=False)
+        rv = {}
+        for name in include or schema["properties"]:
+            if exclude and name in exclude:
+                continue
+            attr = schema["properties"][name]
+            type_ = attr["type"]
+            if type_ == "array" and "items" in attr:
+                type_ = f"<array<{attr['items']['type']}>><array<str>>"
+            else:
+                type_ = f"<{type_}>"
+            rv[name] = f"{name} := {type_}${name},"
+        return rv
 
+    def _value_names(self, lines):
+        fields_set = self.__fields_set__
+        return tuple(
+            name
+            for name in self.__dict__
+            if name in lines and name in fields_set
+        )
+
+    @classmethod
     def _compile_values(
-        self, schema, buf, extra_values, include, exclude=None
+        cls, current_module, parts, names, extra_values, include, exclude=None
     ):
-        d = self.dict(
-            include=include or set(schema["properties"]),
-            exclude=exclude,
-            exclude_unset=True,
-        )
-        if d or extra_values:
-            with _curley_braces(buf) as inf:
-                for name, value in d.items():
-                    if name in extra_values:
-                        continue
-                    attr = schema["properties"][name]
-                    type_ = attr["type"]
-                    if type_ == "array" and "items" in attr:
-                        type_ = f"<array<{attr['items']['type']}>><array<str>>"
-                    else:
-                        type_ = f"<{type_}>"
-                    print(f"{name} := {type_}${name},", file=inf)
-                for name, value in extra_values.items():
-                    print(f"{name} := ({value}),", file=inf)
+        lines = cls._compile_value_lines(current_module, include, exclude)
+        if names or extra_values:
+            extra_names = {name for name, _ in extra_values}
+            values = [lines[name] for name in names if name not in extra_names]
+            values.extend(
+                f"{name} := ({value})," for name, value in extra_values
+            )
+            parts.append(_compile_block(values))
             return True
         else:
             return False
@@ -171,22 +235,42 @@ class DatabaseModel(BaseModel):
         conflict_else=None,
         **extra_values,
     ):
-        buf = io.StringIO()
-        schema = self.edb_schema(current_module, self_only=False)
-        buf.write(f"INSERT {schema['title']}")
+        include = include and frozenset(include)
+        lines = self._compile_value_lines(current_module, include, None)
+        return self._compile_insert(
+            current_module,
+            include,
+            self._value_names(lines),
+            tuple(extra_values.items()),
+            conflict_on,
+            conflict_else,
+        )
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _compile_insert(
+        cls,
+        current_module,
+        include,
+        names,
+        extra_values,
+        conflict_on,
+        conflict_else,
+    ):
+        schema = cls.edb_schema(current_module, self_only=False)
+        parts = [f"INSERT {schema['title']}"]
         if (
-            not self._compile_values(schema, buf, extra_values, include)
+            not cls._compile_values(
+                current_module, parts, names, extra_values, include
+            )
             and conflict_on
         ):
-            buf.write(" ")
+            parts.append(" ")
         if conflict_on:
-            buf.write("UNLESS CONFLICT ")
-            if conflict_on:
-                buf.write("ON ")
-                buf.write(conflict_on)
-                if conflict_else:
-                    buf.write(f" ELSE ({conflict_else.strip()})")
-        return buf.getvalue()
+            parts.append(f"UNLESS CONFLICT ON {conflict_on}")
+            if conflict_else:
+                parts.append(f" ELSE ({conflict_else.strip()})")
+        return "".join(parts)
 
     def update(
         self,
@@ -196,14 +280,32 @@ class DatabaseModel(BaseModel):
         filters=None,
         **extra_values,
     ):
-        buf = io.StringIO()
-        schema = self.edb_schema(current_module, self_only=False)
-        buf.write(f"UPDATE {schema['title']}")
+        include = include and frozenset(include)
+        exclude = exclude and frozenset(exclude)
+        lines = self._compile_value_lines(current_module, include, exclude)
+        return self._compile_update(
+            current_module,
+            include,
+            exclude,
+            filters,
+            self._value_names(lines),
+            tuple(extra_values.items()),
+        )
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _compile_update(
+        cls, current_module, include, exclude, filters, names, extra_values
+    ):
+        schema = cls.edb_schema(current_module, self_only=False)
+        parts = [f"UPDATE {schema['title']}"]
         if filters:
-            buf.write(f" FILTER {filters}")
-        buf.write(" SET")
-        self._compile_values(schema, buf, extra_values, include, exclude)
-        return buf.getvalue()
+            parts.append(f" FILTER {filters}")
+        parts.append(" SET")
+        cls._compile_values(
+            current_module, parts, names, extra_values, include, exclude
+        )
+        return "".join(parts)
 
     class Config:
         @staticmethod
@@ -213,13 +315,11 @@ class DatabaseModel(BaseModel):
 
 class Declaration:
     def __init__(self):
-        frame = inspect.currentframe()
-        while frame.f_locals.get("self", None) is self:
-            frame = frame.f_back
-        frame.f_locals.setdefault("__declarations__", []).append(self)
+        if _declarations_stack:
+            _declarations_stack[-1].append(self)
 
-    def compile(self, buf: TextIO):
-        pass
+    def compile(self) -> str:
+        return ""
 
 
 class Constraint(Declaration):
@@ -228,16 +328,16 @@ class Constraint(Declaration):
         self.name = name
         self.on = on
 
-    def compile(self, buf: TextIO):
-        buf.write(f"constraint {self.name}")
+    def compile(self) -> str:
         if self.on:
-            buf.write(f" on ({self.on})")
-        print(";", file=buf)
+            return f"constraint {self.name} on ({self.on});\n"
+        else:
+            return f"constraint {self.name};\n"
 
 
 class ExclusiveConstraint(Constraint):
     def __init__(self, *properties):
-        props_str = ", ".join((f".{name}" for name in properties))
+        props_str = ", ".join([f".{name}" for name in properties])
         if len(properties) > 1:
             props_str = f"({props_str})"
         super().__init__("exclusive", props_str)
@@ -250,10 +350,9 @@ class ComputableProperty(Declaration):
         self.expression = expression
         self.required = required
 
-    def compile(self, buf: TextIO):
-        if self.required:
-            buf.write("required ")
-        print(f"property {self.name} := ({self.expression});", file=buf)
+    def compile(self) -> str:
+        required = "required " if self.required else ""
+        return f"{required}property {self.name} := ({self.expression});\n"
 
 
 class ExtendedComputableProperty(Declaration):
@@ -266,30 +365,22 @@ class ExtendedComputableProperty(Declaration):
         self.required = required
         self.exclusive = exclusive
 
-    def compile(self, buf: TextIO):
-        if self.required:
-            buf.write("required ")
-        with _curley_braces(
-            buf, f"property {self.name}", semicolon=True
-        ) as inf:
-            print(f"USING ({self.expression});", file=inf)
-            if self.exclusive:
-                print("constraint exclusive;", file=inf)
+    def compile(self) -> str:
+        required = "required " if self.required else ""
+        parts = [
+            f"{required}property {self.name} {{\n",
+            f"    USING ({self.expression});\n",
+        ]
+        if self.exclusive:
+            parts.append("    constraint exclusive;\n")
+        parts.append("};\n")
+        return "".join(parts)
 
 
 def with_block(module=None, **expressions):
-    f = io.StringIO()
-    f.write("WITH ")
-    if module:
-        f.write(f"MODULE {module}")
-        if expressions:
-            f.write(", ")
-    for i, (name, exp) in enumerate(expressions.items()):
-        f.write(f"{name} := ({exp})")
-        if i < len(expressions) - 1:
-            f.write(", ")
-    f.write("\n")
-    return f.getvalue()
+    items = [f"MODULE {module}"] if module else []
+    items.extend(f"{name} := ({exp})" for name, exp in expressions.items())
+    return f"WITH {', '.join(items)}\n"
 
 
 ActualType = TypeVar("ActualType")
@@ -304,124 +395,112 @@ def prop(type_: Type[ActualType], **kwargs) -> Type[ActualType]:
     return _Type
 
 
+def get_module_models(py_mod):
+    """Returns the models defined in the given Python module."""
+    return _models_by_module.get(py_mod.__name__, [])
+
+
 @lru_cache()
 def get_models():
     from .idp.base import get_idps
 
     py_mods = []
-    for ep in entry_points()["authub.modules"]:
+    for ep in get_entry_points("authub.modules"):
         py_mod = ep.load()
         py_mods.append((ep.name, py_mod))
 
     for idp in get_idps().values():
         py_mods.append((idp.name, idp.module))
 
-    py_mod_names = set()
-    for name, py_mod in py_mods:
-        py_mod_names.add(py_mod.__name__)
-
     models = {}
     for name, py_mod in py_mods:
-        for k in dir(py_mod):
-            if k.startswith("_"):
-                continue
-            v = getattr(py_mod, k)
-            if not DatabaseModel.issubclass(v):
-                continue
-            if (
-                v.__module__ in py_mod_names
-                and v.__module__ != py_mod.__name__
-            ):
-                continue
+        py_models = get_module_models(py_mod)
+        for v in sorted(py_models, key=lambda m: m.__name__):
             models[v] = None
             if "__edb_module__" not in v.__dict__:
                 v.__edb_module__ = name
+
+    # Only now that every model knows its module can the schemas be built,
+    # for both the model's own module and the default one that queries use.
+    for v in models:
+        for current_module in {v.__edb_module__, "default"}:
+            v.edb_schema(current_module)
+            v.edb_schema(current_module, self_only=False)
     return list(models)
 
 
-class IndentIO(io.TextIOBase):
-    def __init__(self, wrapped_io):
-        self._io = wrapped_io
-        self._indent = True
-
-    def write(self, text: str) -> int:
-        rv = 0
-        if self._indent:
-            rv += self._io.write("    ")
-        self._indent = False
-        if text.endswith("\n"):
-            text = text[:-1]
-            self._indent = True
-        rv += self._io.write(text.replace("\n", "\n    "))
-        if self._indent:
-            rv += self._io.write("\n")
-        return rv
+def _indent(text: str) -> str:
+    """Indents each line of the given newline-terminated text."""
+    return "    " + text[:-1].replace("\n", "\n    ") + "\n"
+
 
+def _compile_block(lines) -> str:
+    """Renders the given lines in a pair of curly braces.
 
-@contextlib.contextmanager
-def _curley_braces(f: TextIO, text: str = "", semicolon=False) -> TextIO:
-    print(text + " {", file=f)
-    yield IndentIO(f)
-    if semicolon:
-        print("};", file=f)
-    else:
-        print("}", file=f)
+    Queries are read by the server only, so no indentation is spent on them.
+    """
+    return " { " + " ".join(lines) + " } "
 
 
-def _compile_definitions(f: TextIO, models: List[Type[DatabaseModel]]):
+def _compile_definitions(schemas: List[dict]) -> str:
     definitions = {}
-    for v in models:
-        schema = v.edb_schema(v.__edb_module__)
+    for schema in schemas:
         for name, definition in schema["definitions"].items():
             definitions[name] = definition
+    parts = []
     for name, definition in definitions.items():
         choices = ", ".join((str(val) for val in definition["enum"]))
-        print(f"scalar type {name} extending enum<{choices}>;", file=f)
+        parts.append(f"scalar type {name} extending enum<{choices}>;\n")
     if definitions:
-        print(file=f)
+        parts.append("\n")
+    return "".join(parts)
 
 
-def _compile_schema(f: TextIO, v: Type[DatabaseModel]):
-    schema = v.edb_schema(v.__edb_module__)
+def _compile_schema(schema: dict) -> str:
     extending = ""
     if schema["parents"]:
         extending = " extending " + ", ".join(schema["parents"])
-    with _curley_braces(f, f"type {schema['title']}{extending}") as tf:
-        for name, attr in schema["properties"].items():
-            if attr.get("required"):
-                tf.write("required ")
-            tf.write(f"{attr['declaration']} {name} -> {attr['type']}")
-            if "items" in attr:
-                tf.write(f"<{attr['items']['type']}>")
-            if "constraint" in attr:
-                with _curley_braces(tf, semicolon=True) as af:
-                    af.write("constraint ")
-                    af.write(attr["constraint"])
-                    print(";", file=af)
-            else:
-                print(";", file=tf)
-        for dec in schema["declarations"]:
-            dec.compile(tf)
+    parts = [f"type {schema['title']}{extending} {{\n"]
+    for name, attr in schema["properties"].items():
+        required = "required " if attr.get("required") else ""
+        type_ = attr["type"]
+        if "items" in attr:
+            type_ += f"<{attr['items']['type']}>"
+        line = f"{required}{attr['declaration']} {name} -> {type_}"
+        if "constraint" in attr:
+            constraint = attr["constraint"]
+            parts.append(
+                _indent(f"{line} {{\n    constraint {constraint};\n}};\n")
+            )
+        else:
+            parts.append(f"    {line};\n")
+    for dec in schema["declarations"]:
+        text = dec.compile()
+        if text:
+            parts.append(_indent(text))
+    parts.append("}\n")
+    return "".join(parts)
 
 
 def compile_schema(schema_dir):
     """Update database schema SDL."""
 
-    models_by_module_name = {}
+    schemas_by_module_name = {}
     for model in get_models():
-        models_by_module_name.setdefault(model.__edb_module__, []).append(
-            model
+        module_name = model.__edb_module__
+        schemas_by_module_name.setdefault(module_name, []).append(
+            model.edb_schema(module_name)
         )
 
-    for module_name, models in models_by_module_name.items():
-        buf = io.StringIO()
-        with _curley_braces(
-            buf, f"module {module_name}", semicolon=True
-        ) as mf:
-            _compile_definitions(mf, models)
-            for i, v in enumerate(models):
-                _compile_schema(mf, v)
-                if i < len(models) - 1:
-                    print(file=buf)
-        with (schema_dir / f"{module_name}.esdl").open("w") as f:
-            f.write(buf.getvalue())
+    for module_name, schemas in schemas_by_module_name.items():
+        parts = [f"module {module_name} {{\n"]
+        definitions = _compile_definitions(schemas)
+        if definitions:
+            parts.append(_indent(definitions))
+        for i, schema in enumerate(schemas):
+            parts.append(_indent(_compile_schema(schema)))
+            if i < len(schemas) - 1:
+                parts.append("\n")
+        parts.append("};\n")
+        with open(os.path.join(schema_dir, f"{module_name}.esdl"), "w") as f:
+            f.write("".join(parts))
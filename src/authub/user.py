@@ -1,14 +1,15 @@
 from typing import List
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, Request, status, HTTPException
+from fastapi import APIRouter, Depends, Request, status
 from fastapi.responses import Response, RedirectResponse
 from pydantic import BaseModel
 from starlette.middleware.authentication import AuthenticationMiddleware
 
-from .http import get_edgedb_pool
+from .http import get_edgedb_pool, not_found_response
 from .models import User, Identity
 from .oauth2 import OAuth2Backend
+from .utils import url_template_for
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
@@ -16,7 +17,10 @@ router = APIRouter(prefix="/users", tags=["Users"])
 @router.get("/", response_model=List[User], summary="List all the users.")
 async def list_users(db=Depends(get_edgedb_pool)):
     objects = await db.query(User.select("name", "email"))
-    return [User.from_obj(obj) for obj in objects]
+    return [
+        User.construct(id=obj.id, name=obj.name, email=obj.email)
+        for obj in objects
+    ]
 
 
 class IdentityOut(BaseModel):
@@ -41,18 +45,17 @@ async def list_user_identities(
         ),
         id=user_id,
     )
-    return [
-        IdentityOut(
-            client_name=": ".join(
-                (
-                    identity.__type__.name.split("::")[0],
-                    identity.client.name,
-                )
-            ),
-            href=request.url_for("get_identity", identity_id=identity.id),
+    identity_url = url_template_for(request, "get_identity", "identity_id")
+    rv = []
+    for obj in objects:
+        mod = obj.__type__.name.partition("::")[0]
+        rv.append(
+            IdentityOut(
+                client_name=f"{mod}: {obj.client.name}",
+                href=identity_url(obj.id),
+            )
         )
-        for identity in (Identity.from_obj(obj) for obj in objects)
-    ]
+    return rv
 
 
 async def _redirect_identity(db, identity_id, request, name):
@@ -60,7 +63,7 @@ async def _redirect_identity(db, identity_id, request, name):
         Identity.select("__type__: { name }", filters=".id = <uuid>$id"),
         id=identity_id,
     )
-    mod = result.__type__.name.split("::")[0]
+    mod = result.__type__.name.partition("::")[0]
     return RedirectResponse(
         request.url_for(f"{mod}.{name}", identity_id=identity_id),
         status_code=status.HTTP_302_FOUND,
@@ -96,7 +99,7 @@ async def delete_identity(identity_id: UUID, db=Depends(get_edgedb_pool)):
     if result:
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        return not_found_response()
 
 
 @router.patch(
@@ -0,0 +1,50 @@
+from functools import lru_cache
+from importlib.metadata import entry_points
+
+
+@lru_cache()
+def _get_all_entry_points():
+    return entry_points()
+
+
+@lru_cache()
+def get_entry_points(group: str):
+    """Returns the entry points of the given group.
+
+    The installed distributions are scanned only once for all groups.
+    """
+    eps = _get_all_entry_points()
+    if hasattr(eps, "select"):
+        return tuple(eps.select(group=group))
+    else:
+        return tuple(eps.get(group, ()))
+
+
+_PATH_PARAM_PLACEHOLDER = "__authub_path_param__"
+
+
+def url_template_for(request, name: str, param: str):
+    """Returns a function building absolute URLs of the named route.
+
+    The route is resolved only once per app and kept in the app state; the
+    returned function fills the given path parameter by string replacement,
+    for building many URLs cheaply.
+    """
+    state = request.app.state
+    try:
+        url_paths = state.authub_url_paths
+    except AttributeError:
+        url_paths = state.authub_url_paths = {}
+    url_path = url_paths.get((name, param))
+    if url_path is None:
+        router = request.scope["router"]
+        url_path = router.url_path_for(
+            name, **{param: _PATH_PARAM_PLACEHOLDER}
+        )
+        url_paths[name, param] = url_path
+    url = str(url_path.make_absolute_url(base_url=request.base_url))
+
+    def url_for(value) -> str:
+        return url.replace(_PATH_PARAM_PLACEHOLDER, str(value))
+
+    return url_for
@@ -0,0 +1,25 @@
+import unittest
+
+from pydantic import create_model
+
+from authub.orm import DatabaseModel, ExclusiveConstraint, _declarations_stack
+
+
+class DeclarationsTest(unittest.TestCase):
+    def test_class_body(self):
+        class Model(DatabaseModel):
+            name: str
+            ExclusiveConstraint("name")
+
+        self.assertEqual(len(Model.__declarations__), 1)
+        self.assertEqual(_declarations_stack, [])
+
+    def test_create_model(self):
+        class Model(DatabaseModel):
+            name: str
+            ExclusiveConstraint("name")
+
+        clone = create_model("Clone", __base__=Model)
+        self.assertEqual(clone.__declarations__, [])
+        self.assertEqual(len(Model.__declarations__), 1)
+        self.assertEqual(_declarations_stack, [])